@@ -18,7 +18,8 @@ setuptools.setup(
         "Operating System :: POSIX :: Linux",
         "Environment :: Console"
     ],
-    install_requires=['pika'],
+    install_requires=['pika>=0.12,<1.0'],
+    extras_require={'orjson': ['orjson']},
     packages=setuptools.find_packages('src'),
     package_dir={'':'src'},
     entry_points={
@@ -1,45 +1,89 @@
 #!/bin/env python3
 
 import argparse
+import functools
 import logging
 import signal
 import sys
 import os
-import json
+import pathlib
+import random
+import socket
 import subprocess
+import queue
+import threading
 import pika
-from time import sleep
+from time import sleep, monotonic
+
+try:
+    from orjson import loads as json_loads, dumps as json_dumps
+except ImportError:
+    import json
+    json_loads = json.loads
+
+    def json_dumps(obj):
+        return json.dumps(obj).encode('utf-8')
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s: %(message)s',
                     handlers=[logging.StreamHandler(sys.stdout)])
 logger = logging.getLogger('RPiMusic')
 
+# shutdown sentinel for the worker queues, can never collide with a URL
+_STOP = object()
+
 class RPiMusic:
     STARTUP_TIMEOUT = 5
+    STARTUP_POLL_INTERVAL = 0.05
+    RECONNECT_MIN_DELAY = 1
+    RECONNECT_MAX_DELAY = 60
     PLAYER = '/usr/bin/mpv'
     PLAYER_ARGS = ['--no-terminal']
+    PLAYER_SOCKET = '/run/rpimusic/mpv.sock'
 
     def __init__(self, configfile):
         self.exit_flag = False
+        self.consuming = False
         self._amqp_channel = None
-        self._parse_config(os.path.expanduser(configfile))
-        self._url_cache_file = os.path.expanduser(self._url_cache_file)
+        self._connection = None
+        self._process = None
+        self._ipc = None
+        self._ipc_reader = None
+        self._player_error = None
+        self._argv_prefix = (RPiMusic.PLAYER, *RPiMusic.PLAYER_ARGS,
+                             '--idle=yes', '--input-ipc-server={}'.format(RPiMusic.PLAYER_SOCKET))
+        self._configfile = os.path.expanduser(configfile)
+        self._parse_config(self._configfile)
         logger.info('fallback url set to %s', self._fallback_playlist_url)
         logger.info('trying to load last URL from %s', self._url_cache_file)
         try:
-            with open(self._url_cache_file, 'r') as fh:
-                jsondata = json.loads(fh.read())
-                self._current_playlist_url = jsondata['playlisturl']
-                logger.info('restored last url: %s', self._current_playlist_url)
-        except (FileNotFoundError, KeyError):
+            jsondata = json_loads(pathlib.Path(self._url_cache_file).read_bytes())
+            self._current_playlist_url = jsondata['playlisturl']
+            logger.info('restored last url: %s', self._current_playlist_url)
+        except (FileNotFoundError, KeyError, ValueError, TypeError):
             logger.info('unable to load URL, using fallback url')
             self._current_playlist_url = self._fallback_playlist_url
+        self._cache_queue = queue.Queue(maxsize=1)
+        self._cache_writer = threading.Thread(target=self._write_cache, name='cachewriter', daemon=True)
+        self._cache_writer.start()
+        self._player_lock = threading.RLock()
+        self._player_queue = queue.Queue(maxsize=1)
+        self._player_thread = threading.Thread(target=self._run_player, name='player', daemon=True)
+        self._player_thread.start()
 
     def start(self):
         logger.info('starting...')
+        self.consuming = False
+        if self._player_error:
+            # the player failed while there was no connection to report it on
+            raise self._player_error
         self._setup_amqp_connection()
         self._setup_amqp_queue()
-        self._start_player()
+        # a player that survived a reconnect keeps playing. the lock makes us
+        # wait for a player start that is still in progress
+        with self._player_lock:
+            if not self._ipc:
+                self._put_latest(self._player_queue, self._current_playlist_url)
+        self.consuming = True
         self._amqp_channel.start_consuming()
 
     def _setup_amqp_queue(self):
@@ -53,78 +97,217 @@ class RPiMusic:
     def _handle_msg(self, channel, method_frame, properties, body):
         logger.debug('msgid %d: got message', method_frame.delivery_tag)
         try:
-            message = body.decode('utf-8')
-            jsondata = json.loads(message)
+            jsondata = json_loads(body)
             playlisturl = jsondata['playlisturl']
-        except (KeyError, ValueError, AttributeError, TypeError):
+            if not isinstance(playlisturl, str):
+                raise TypeError('playlisturl is not a string')
+        except (KeyError, ValueError, TypeError):
             logger.error('msgid %d: handling error:', method_frame.delivery_tag, exc_info=True)
             channel.basic_nack(delivery_tag=method_frame.delivery_tag, requeue=False)
         else:
             self._set_playlisturl(playlisturl)
             channel.basic_ack(delivery_tag=method_frame.delivery_tag)
-            self._stop_player()
+            self._put_latest(self._player_queue, playlisturl)
+
+    def _run_player(self):
+        # starting and talking to the player may block, so it is done here
+        # instead of on the amqp connection thread
+        while True:
+            playlisturl = self._player_queue.get()
+            if playlisturl is _STOP or self.exit_flag:
+                break
+            try:
+                self._load_url(playlisturl)
+            except Exception as err:
+                logger.error('player error, giving up: %s', err)
+                self._player_error = err
+                try:
+                    self._connection.add_callback_threadsafe(functools.partial(self._raise, err))
+                except (AttributeError, pika.exceptions.ConnectionClosed):
+                    pass
+
+    @staticmethod
+    def _raise(err):
+        raise err
+
+    def _load_url(self, playlisturl):
+        with self._player_lock:
+            if self._ipc:
+                try:
+                    self._player_command('loadfile', playlisturl)
+                    return
+                except OSError:
+                    logger.warning('lost player ipc connection, restarting player', exc_info=True)
+                    self.stop_player()
             self._start_player()
 
     def _start_player(self):
-        args = [RPiMusic.PLAYER, ]
-        args.extend(RPiMusic.PLAYER_ARGS)
-        args.extend([self._current_playlist_url])
-        logger.info('run %s', str(args))
-        self._process = subprocess.Popen(args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        args = (*self._argv_prefix, self._current_playlist_url)
         try:
-            retcode = self._process.wait(timeout=RPiMusic.STARTUP_TIMEOUT)
-        except subprocess.TimeoutExpired:
+            os.unlink(RPiMusic.PLAYER_SOCKET)
+        except FileNotFoundError:
             pass
-        else:
-            if self.exit_flag:
-                pass
-            else:
-                logger.error('subprocess dead after %d seconds, assuming failure', RPiMusic.STARTUP_TIMEOUT)
+        logger.info('run %s', str(args))
+        # close_fds=False lets subprocess use posix_spawn instead of fork/exec,
+        # our own fds are non-inheritable anyway
+        self._process = subprocess.Popen(args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, close_fds=False)
+        deadline = monotonic() + RPiMusic.STARTUP_TIMEOUT
+        while True:
+            retcode = self._process.poll()
+            if retcode is not None:
+                if self.exit_flag:
+                    return
+                logger.error('subprocess died during startup, assuming failure')
                 raise subprocess.CalledProcessError(retcode, cmd=args)
+            ipc = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            ipc.settimeout(RPiMusic.STARTUP_TIMEOUT)
+            try:
+                ipc.connect(RPiMusic.PLAYER_SOCKET)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                # mpv has not created the socket or is not listening on it yet
+                ipc.close()
+            except OSError:
+                ipc.close()
+                self.stop_player()
+                raise
+            if monotonic() > deadline:
+                logger.error('no ipc socket after %d seconds, assuming failure', RPiMusic.STARTUP_TIMEOUT)
+                self.stop_player()
+                raise subprocess.TimeoutExpired(args, RPiMusic.STARTUP_TIMEOUT)
+            sleep(RPiMusic.STARTUP_POLL_INTERVAL)
+        ipc_reader = ipc.makefile('rb')
+        try:
+            # we only care about command replies, keep mpv from flooding the socket with events
+            self._ipc_command(ipc, ipc_reader, ('disable_event', 'all'))
+        except (OSError, ValueError):
+            ipc_reader.close()
+            ipc.close()
+            self.stop_player()
+            raise
+        self._ipc, self._ipc_reader = ipc, ipc_reader
+
+    def _player_command(self, *command):
+        return self._ipc_command(self._ipc, self._ipc_reader, command)
+
+    @staticmethod
+    def _ipc_command(ipc, ipc_reader, command):
+        ipc.sendall(json_dumps({'command': command}) + b'\n')
+        # skip over any events until we get the reply to our command
+        for line in ipc_reader:
+            reply = json_loads(line)
+            if 'error' in reply:
+                if reply['error'] != 'success':
+                    logger.error('player command %s failed: %s', str(command), reply['error'])
+                return reply
+        raise ConnectionResetError('player closed ipc connection')
 
     def _set_playlisturl(self, playlisturl):
-        with open(self._url_cache_file, 'w') as fh:
-            content = {"playlisturl": playlisturl}
-            fh.write(json.dumps(content))
+        if playlisturl == self._current_playlist_url:
+            logger.debug('url unchanged, not updating cache')
+            return
         self._current_playlist_url = playlisturl
+        self._put_latest(self._cache_queue, playlisturl)
 
-    def stop_player(self):
-        if self._process:
+    @staticmethod
+    def _put_latest(q, item):
+        # single-slot queue: replace whatever is still pending with the newest item
+        while True:
+            try:
+                q.put_nowait(item)
+                return
+            except queue.Full:
+                try:
+                    q.get_nowait()
+                except queue.Empty:
+                    pass
+
+    def _write_cache(self):
+        while True:
+            playlisturl = self._cache_queue.get()
+            if playlisturl is _STOP:
+                break
+            tmpfile = self._url_cache_file + '.tmp'
+            content = json_dumps({"playlisturl": playlisturl})
             try:
+                # the file is tiny, skip the buffered io layer and write it in one syscall
+                fd = os.open(tmpfile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+                try:
+                    os.write(fd, content)
+                    # make sure the data is on disk before the rename makes it visible
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+                os.replace(tmpfile, self._url_cache_file)
+            except OSError:
+                logger.error('unable to write url cache %s', self._url_cache_file, exc_info=True)
+
+    def stop_player(self):
+        with self._player_lock:
+            if self._ipc:
+                self._ipc_reader.close()
+                self._ipc.close()
+                self._ipc, self._ipc_reader = None, None
+            if self._process:
+                # stdout and stderr go to /dev/null, there is nothing to communicate()
                 self._process.terminate()
-                self._process.communicate(timeout=5)
-            except subprocess.TimeoutExpired:
-                self._process.kill()
-                self._process.communicate(timeout=5)
-            logger.info('stopped player')
+                try:
+                    self._process.wait(timeout=5)
+                except subprocess.TimeoutExpired:
+                    self._process.kill()
+                    self._process.wait()
+                logger.info('stopped player')
 
     def _parse_config(self, configfile):
-        with open(configfile, 'r') as fh:
-            jsondata = json.loads(fh.read())
-            self._amqp_url = jsondata['amqp_url']
-            self._url_cache_file = jsondata['url_cache_file']
-            self._fallback_playlist_url = jsondata['fallback_playlist_url']
-            self._uuid = jsondata['uuid']
+        mtime = os.stat(configfile).st_mtime
+        jsondata = json_loads(pathlib.Path(configfile).read_bytes())
+        # look up all keys first so a broken config never gets applied halfway
+        (self._amqp_url, url_cache_file, self._fallback_playlist_url, self._uuid) = (
+            jsondata['amqp_url'], jsondata['url_cache_file'], jsondata['fallback_playlist_url'], jsondata['uuid'])
+        self._url_cache_file = os.path.expanduser(url_cache_file)
+        self._config_mtime = mtime
+
+    def maybe_reload_config(self):
+        try:
+            if os.stat(self._configfile).st_mtime == self._config_mtime:
+                return
+            self._parse_config(self._configfile)
+        except (OSError, KeyError, ValueError, TypeError):
+            logger.error('unable to reload config %s, keeping old config', self._configfile, exc_info=True)
+        else:
+            logger.info('reloaded config from %s', self._configfile)
 
     def _setup_amqp_connection(self):
         logger.info('connecting amqp')
         parameters = pika.URLParameters(self._amqp_url)
         parameters.ssl = True
-        parameters.heartbeat = 60
+        # the player runs on its own thread, so heartbeats are only a last resort,
+        # dead peers are detected by tcp keepalive
+        parameters.heartbeat = 600
+        parameters.tcp_options = {'TCP_KEEPIDLE': 60, 'TCP_KEEPINTVL': 30, 'TCP_KEEPCNT': 5}
         connection = pika.BlockingConnection(parameters=parameters)
         channel = connection.channel()
+        channel.basic_qos(prefetch_count=1)
         channel.exchange_declare(exchange='Xall', exchange_type='direct')
+        self._connection = connection
         self._amqp_channel = channel
 
     def stop(self, *args):
+        # runs as signal handler, so it must not touch queues, locks or threads
         logger.info('stopping...')
         self.exit_flag = True
         try:
             self._amqp_channel.close()
-            self.stop_player()
         except (AttributeError, pika.exceptions.ConnectionClosed, pika.exceptions.ChannelClosed):
             pass
 
+    def shutdown(self):
+        self._put_latest(self._player_queue, _STOP)
+        self._player_thread.join(timeout=RPiMusic.STARTUP_TIMEOUT * 2)
+        self.stop_player()
+        self._cache_queue.put(_STOP)
+        self._cache_writer.join()
+
 def rpimusicd():
     exitcode = 255
     try:
@@ -142,14 +325,21 @@ def rpimusicd():
         signal.signal(signal.SIGTERM, worker.stop)
         signal.signal(signal.SIGINT, worker.stop)
         exitcode = 3
+        backoff = RPiMusic.RECONNECT_MIN_DELAY
 
         while not worker.exit_flag:
             try:
                 worker.start()
-            except pika.exceptions.ConnectionClosed as err:
-                logger.error('lost rabbitmq connection, restarting in 2s. reason: %s', str(err))
-                worker.stop_player()
-                sleep(5)
+            except pika.exceptions.AMQPConnectionError as err:
+                # covers ConnectionClosed as well as failing to connect while the broker is down
+                if worker.consuming:
+                    # we had a working connection, so this is a fresh outage
+                    backoff = RPiMusic.RECONNECT_MIN_DELAY
+                delay = backoff + random.random()
+                backoff = min(backoff * 2, RPiMusic.RECONNECT_MAX_DELAY)
+                logger.error('lost rabbitmq connection, restarting in %.1fs. reason: %s', delay, str(err))
+                sleep(delay)
+                worker.maybe_reload_config()
             except Exception as err:
                 logger.error('caught fatal error: %s', err, exc_info=cliargs.debug)
                 exitcode = 1
@@ -157,6 +347,7 @@ def rpimusicd():
                 break
             else:
                 exitcode = 0
+        worker.shutdown()
     finally:
         logging.shutdown()
         sys.exit(exitcode)